@@ -20,20 +20,22 @@
 """
 
 import re
-import bson
-import copy
-import datetime
+import struct
+import marshal
+# bson, copy, datetime 延迟到首次使用时import, 只用match的进程不必加载pymongo
 
 class ParseError(Exception):
     pass
 
 def load_bson_id(d):
+    import bson.objectid
     try:
         return bson.objectid.ObjectId(d.get('$oid'))
     except:
         raise ParseError("illegal objectid: %s" % d)
 
 def load_bson_date(d):
+    import datetime
     try:
         return datetime.datetime.utcfromtimestamp(d.get('$date'))
     except:
@@ -63,6 +65,7 @@ def load_bson(value):
         for k, v in value.iteritems():
             ret[k] = load_bson(v)
         return ret
+    import copy
     return copy.deepcopy(value)
 
 
@@ -391,6 +394,62 @@ def encode_mongo(rule, key_trans={}):
     return BaseParser(MongoRule).parse(rule, key_trans).get_value()
 
 
+RULE_DUMP_MAGIC = "MQR"
+RULE_DUMP_VERSION = 1
+RULE_DUMP_HEADER = struct.Struct("<3sB")
+
+def _rule_to_node(rule):
+    if rule.isempty():
+        return None
+    value = rule.value if rule.isatomic() else None
+    children = tuple(_rule_to_node(child) for child in rule.children)
+    return (rule.get_op(), value, children)
+
+
+def _node_to_rule(node, rule_class):
+    rule = rule_class()
+    if node is None:
+        return rule
+    op, value, children = node
+    rule.set_op(op)
+    if rule.isatomic():
+        rule.value = value
+    rule.children = [_node_to_rule(child, rule_class) for child in children]
+    return rule
+
+
+def dump_rule(rule):
+    """
+    解析后的rule -> 二进制数据(header + marshal)
+    has已在解析时转成regex，load时无需重新解析; 只支持json兼容的值
+    """
+    try:
+        body = marshal.dumps(_rule_to_node(rule), 2)
+    except ValueError:
+        raise ParseError("unserializable rule: %s" % rule.data)
+    return RULE_DUMP_HEADER.pack(RULE_DUMP_MAGIC, RULE_DUMP_VERSION) + body
+
+
+def load_rule(s, rule_class=BaseRule):
+    """
+    dump_rule的数据 -> rule, 版本不一致时报错, 需要重新解析
+    """
+    size = RULE_DUMP_HEADER.size
+    try:
+        magic, version = RULE_DUMP_HEADER.unpack(s[:size])
+    except struct.error:
+        raise ParseError("illegal rule dump header")
+    if magic != RULE_DUMP_MAGIC:
+        raise ParseError("illegal rule dump magic: %r" % magic)
+    if version != RULE_DUMP_VERSION:
+        raise ParseError("unsupported rule dump version: %s" % version)
+    try:
+        node = marshal.loads(s[size:])
+        return _node_to_rule(node, rule_class)
+    except (ValueError, EOFError, TypeError):
+        raise ParseError("illegal rule dump data")
+
+
 def find_value(path, data):
     """
     data是一个dict, key用.分割
@@ -492,3 +551,62 @@ def match(rule_obj, data):
         raise ParseError("unsupported rule matcher op: %s" % rule_op)
     return rule_matcher(rule_obj, data)
 
+
+_batch_rule = None
+def _init_batch_matcher(s):
+    global _batch_rule
+    _batch_rule = load_rule(s)
+
+
+def _match_batch(batch):
+    return [match(_batch_rule, data) for data in batch]
+
+
+def _iter_batches(iterable, batch_size):
+    batch = []
+    for data in iterable:
+        batch.append(data)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ifilter(rule_obj, iterable, batch_size=100, processes=0, max_pending=None):
+    """
+    流式过滤iterable, 按顺序返回符合rule的data
+    processes > 0 时按batch_size分批交给进程池match(适合regex等耗cpu的规则),
+    最多max_pending批在途(默认processes * 2), 消费慢时不再继续读取iterable
+    rule通过dump_rule传给子进程, 只支持json兼容的值
+    """
+    if processes <= 0:
+        for data in iterable:
+            if match(rule_obj, data):
+                yield data
+        return
+
+    import collections
+    import multiprocessing
+    if max_pending is None:
+        max_pending = processes * 2
+    pool = multiprocessing.Pool(processes, _init_batch_matcher, (dump_rule(rule_obj),))
+    pending = collections.deque()
+    try:
+        for batch in _iter_batches(iterable, batch_size):
+            pending.append((batch, pool.apply_async(_match_batch, (batch,))))
+            if len(pending) < max_pending:
+                continue
+            batch, result = pending.popleft()
+            for data, matched in zip(batch, result.get()):
+                if matched:
+                    yield data
+
+        while pending:
+            batch, result = pending.popleft()
+            for data, matched in zip(batch, result.get()):
+                if matched:
+                    yield data
+    finally:
+        pool.terminate()
+        pool.join()
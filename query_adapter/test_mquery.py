@@ -3,12 +3,55 @@ import datetime
 import time
 import bson
 import json
+import os
+import sys
+import subprocess
 import mquery
 
 t = int(time.time())
 def test_matcher(rule_data, data):
     return mquery.match(mquery.BaseParser().parse(rule_data), data)
 
+def test_dump_matcher(rule_data, data):
+    s = mquery.dump_rule(mquery.BaseParser().parse(rule_data))
+    return mquery.match(mquery.load_rule(s), data)
+
+def test_dump_mongo(rule_data, key_trans={}):
+    rule = mquery.BaseParser(mquery.MongoRule).parse(rule_data, key_trans)
+    s = mquery.dump_rule(rule)
+    return mquery.load_rule(s, mquery.MongoRule).get_value()
+
+def test_load_data(s):
+    return mquery.match(mquery.load_rule(s), {})
+
+def test_ifilter(rule_data, datas, processes=0, max_pending=None):
+    rule = mquery.BaseParser().parse(rule_data)
+    return list(mquery.ifilter(rule, iter(datas), 2, processes, max_pending))
+
+def test_ifilter_stop(rule_data, datas, n):
+    """只消费前n项, 剩余的data不应被全部读取"""
+    read = []
+    def gen():
+        for data in datas:
+            read.append(data)
+            yield data
+    it = mquery.ifilter(mquery.BaseParser().parse(rule_data), gen(), 2, 1, 1)
+    ret = [it.next() for i in xrange(n)]
+    it.close()
+    return ret, len(read) < len(datas)
+
+def run_python(code):
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.check_output([sys.executable, "-c", code], cwd=cwd).strip()
+
+def test_lazy_import(rule_data, data):
+    """新进程中只用match, 返回被加载的重模块"""
+    code = ("import sys, mquery; "
+            "mquery.match(mquery.BaseParser().parse(%r), %r); "
+            "print ','.join(m for m in ['bson', 'copy', 'datetime'] if m in sys.modules)"
+            % (rule_data, data))
+    return run_python(code)
+
 config = [
     {
         "func": mquery.encode_mongo,
@@ -181,7 +224,80 @@ config = [
               {"key": "c中文d"}], 
              True),
         ]
-    }
+    },
+
+    {
+        "func": test_dump_matcher,
+        "cases": [
+            ([["and", ["=", "key", 1]], {"key": 1}], True),
+            ([["and", ["in", "key", [1, 2]]], {"key": 3}], False),
+            ([["and", ["range", "key", [1, 2]]], {"key": 1.5}], True),
+            ([["not", ["has", "key", ["a", "b", "中文"]]], {"key": "c中文d"}], False),
+            ([["or", ["=", "key1", "a"], ["and", ["=", "key2", "b"], ["<", "key3", 3]]],
+              {"key1": "x", "key2": "b", "key3": 1}],
+             True),
+            ([["and"], {"key": 1}], True),
+        ]
+    },
+
+    {
+        "func": test_dump_mongo,
+        "cases": [
+            ([["has", "key", ["a", "b", "c"]]], {"key": {"$regex": "a|b|c"}}),
+            ([["range", "key", ["a", "b"]], {"key": "key_b"}],
+             {"key_b": {"$gte": "a", "$lte": "b"}}
+            ),
+            ([["not", ["or", ["and", ["in", "key1", ["a", "b"]], ["=", "key2", "a"]]]]],
+             {"$not": {"key1":{"$in": ["a", "b"]}, "key2":"a"}}
+            ),
+            ([["=", "key", {"$oid": "51622af03321b445eb2b2339"}]],
+             {"key": bson.objectid.ObjectId("51622af03321b445eb2b2339")}
+            ),
+            ([["not", ["not"]]], {}),
+            ([["=", "key", datetime.datetime(2013, 3, 28)]], None), # unserializable
+        ]
+    },
+
+    {
+        "func": test_load_data,
+        "cases": [
+            (["MQ"], None), # illegal header
+            (["XYZ\x01"], None), # illegal magic
+            (["MQR\x02"], None), # unsupported version
+            (["MQR\x01\xff"], None), # illegal data
+        ]
+    },
+
+    {
+        "func": test_lazy_import,
+        "cases": [
+            ([["and", ["in", "key", [1, 2]], ["has", "key2", ["a", "b"]]],
+              {"key": 1, "key2": "abc"}],
+             ""),
+        ]
+    },
+
+    {
+        "func": test_ifilter,
+        "cases": [
+            ([["in", "key", [1, 3]], [{"key": i} for i in range(5)]],
+             [{"key": 1}, {"key": 3}]),
+            ([["has", "key", ["a", "中文"]], [{"key": "c中文d"}, {"key": "b"}, {"key": "a"}], 2],
+             [{"key": "c中文d"}, {"key": "a"}]),
+            ([["range", "key", [10, 20]], [{"key": i} for i in range(30)], 3, 1],
+             [{"key": i} for i in range(10, 21)]),
+            ([["and"], [], 2], []),
+            ([["=", "key", datetime.datetime(2013, 3, 28)], [{"key": 1}], 2], None), # unserializable
+        ]
+    },
+
+    {
+        "func": test_ifilter_stop,
+        "cases": [
+            ([[">=", "key", 0], [{"key": i} for i in range(100)], 3],
+             ([{"key": 0}, {"key": 1}, {"key": 2}], True)),
+        ]
+    },
 ]
 
 
@@ -216,6 +332,19 @@ def test():
         print "test ", func, "pass:%s, fail:%s" % (npass, nfail)
 
 
+def bench_import(n=10):
+    """import耗时: 只import mquery vs 同时加载bson"""
+    for code in ["import mquery", "import mquery, bson"]:
+        cost = float(run_python("import timeit; print timeit.timeit(%r, number=1)" % code))
+        total = 0.0
+        for i in xrange(n):
+            begin = time.time()
+            run_python(code)
+            total += time.time() - begin
+        print "bench import: %-24s %.1fms (process %.1fms)" % (code, cost * 1000, total / n * 1000)
+
+
 if __name__ == "__main__":
     test()
+    bench_import()
     